@@ -1,16 +1,11 @@
-import os
-from langchain_openai import ChatOpenAI
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_core.messages import HumanMessage, SystemMessage
 from tools import tavily_search
+from model_router import router, RoutedAgent
 
-# Initialize DeepSeek LLM (OpenAI Compatible)
-llm = ChatOpenAI(
-    model='deepseek-chat', 
-    openai_api_key=os.environ.get("DEEPSEEK_API_KEY"), 
-    openai_api_base='https://api.deepseek.com',
-    max_tokens=1024
-)
+# DeepSeek LLM (OpenAI Compatible) 由路由器按角色/步骤选择档位，见 model_router.py
+# 启用磁带 (FINCHAIN_CASSETTE_MODE) 时，所有模型调用都会经过录制/回放缓存
+llm = router.model("standard")
 
 from datetime import datetime
 
@@ -18,27 +13,33 @@ from datetime import datetime
 current_date = "2024-11-21" 
 
 # --- 金融分析师智能体工厂 (Financial Analyst Agent Factory) ---
-def create_analyst_agent(name: str):
+# 系统提示词对三位分析师完全相同 (不含分析师名称)，以便共享 DeepSeek 的前缀缓存；
+# 分析师身份与审计反馈由 prompts.analyst_messages 放在消息末尾。
+analyst_system_prompt = (
+    f"你是一名金融分析师，与另外两位分析师并行竞争。当前日期: {current_date}。\n"
+    "你的目标是根据用户查询提供深刻的金融分析。"
+    "你必须使用 'tavily_search' 工具来收集实时信息。"
+    "如果找不到当前日期的实时数据，请使用最新的可用数据。\n"
+    "收集信息后，撰写一份全面的报告。"
+    "尽可能包含引用来源。"
+)
+
+def create_analyst_agent():
     """
-    创建一个具有特定名称的金融分析师智能体。
+    创建一个金融分析师智能体。
     每个分析师都有相同的目标：使用工具搜索信息并撰写报告。
     """
     prompt = ChatPromptTemplate.from_messages([
-        ("system", f"你是金融分析师 {name}。当前日期: {current_date}。\n"
-                   "你的目标是根据用户查询提供深刻的金融分析。"
-                   "你必须使用 'tavily_search' 工具来收集实时信息。"
-                   "如果找不到当前日期的实时数据，请使用最新的可用数据。\n"
-                   "收集信息后，撰写一份全面的报告。"
-                   "尽可能包含引用来源。"),
+        SystemMessage(content=analyst_system_prompt),
         MessagesPlaceholder(variable_name="messages"),
     ])
-    # 将 Tavily 搜索工具绑定到 LLM
-    return prompt | llm.bind_tools([tavily_search])
+    # 将 Tavily 搜索工具绑定到路由后的 LLM
+    return RoutedAgent(router, "analyst", prompt, tools=[tavily_search])
 
 # 创建 3 位并行工作的分析师
-analyst_a = create_analyst_agent("A")
-analyst_b = create_analyst_agent("B")
-analyst_c = create_analyst_agent("C")
+analyst_a = create_analyst_agent()
+analyst_b = create_analyst_agent()
+analyst_c = create_analyst_agent()
 
 # --- 审计员智能体 (裁判) ---
 # 审计员负责评估三份报告并选出最佳者
@@ -49,14 +50,13 @@ auditor_prompt = ChatPromptTemplate.from_messages([
                "1. 审查所有报告的准确性、深度和数据支持。\n"
                "2. 选出【最佳】报告。\n"
                "3. 对获胜者进行点评，并解释为什么它获胜。\n"
-               "4. 仅以以下 JSON 格式输出结果（不要使用 Markdown）：\n"
+               "4. 仅以以下 JSON 格式输出结果（不要使用 Markdown，无需复述报告全文，系统会自动附上获胜报告）：\n"
                "{{\n"
                "  \"winner\": \"Analyst_A\" 或 \"Analyst_B\" 或 \"Analyst_C\",\n"
-               "  \"reason\": \"详细的理由说明...\",\n"
-               "  \"final_report\": \"获胜报告的完整内容...\"\n"
+               "  \"reason\": \"详细的理由说明...\"\n"
                "}}\n"
                "如果所有报告都很差，你可以拒绝所有，但请尽量选出相对最好的一个。"),
     MessagesPlaceholder(variable_name="messages"),
 ])
 
-auditor_agent = auditor_prompt | llm
+auditor_agent = RoutedAgent(router, "auditor", auditor_prompt)
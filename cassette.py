@@ -0,0 +1,230 @@
+import os
+import gzip
+import json
+import time
+import hashlib
+import tempfile
+import threading
+import warnings
+from langchain_core.caches import BaseCache
+from langchain_core.load import dumps, loads
+
+# --- 录制/回放磁带层 (Record & Replay Cassettes) ---
+# 通过环境变量控制：
+#   FINCHAIN_CASSETTE_MODE     off (默认) / record / replay
+#   FINCHAIN_CASSETTE_DIR      磁带目录，默认 cassettes/default
+#   FINCHAIN_CASSETTE_LATENCY  回放时模拟延迟的倍数，0 表示不模拟，1.0 表示按录制时的真实耗时
+# 每条请求按内容寻址 (SHA256)，响应以 gzip 压缩的 JSON 单独存储，便于去重和版本管理。
+
+MODES = ("off", "record", "replay")
+
+
+class CassetteMissError(KeyError):
+    """回放模式下找不到对应的录制记录。"""
+
+
+class Cassette:
+    def __init__(self, directory: str, mode: str = "off", latency_scale: float = 0.0):
+        if mode not in MODES:
+            raise ValueError(f"未知的磁带模式: {mode}，可选值: {', '.join(MODES)}")
+        self.directory = directory
+        self.mode = mode
+        self.latency_scale = latency_scale
+
+    @property
+    def enabled(self):
+        return self.mode != "off"
+
+    def key(self, kind: str, request) -> str:
+        """根据请求内容计算内容寻址的键。"""
+        payload = json.dumps({"kind": kind, "request": request}, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def _path(self, kind: str, key: str) -> str:
+        return os.path.join(self.directory, kind, key[:2], f"{key}.json.gz")
+
+    def load(self, kind: str, key: str):
+        """读取一条记录，不存在时返回 None。"""
+        path = self._path(kind, key)
+        if not os.path.exists(path):
+            return None
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            return json.load(f)
+
+    def save(self, kind: str, key: str, request, response, elapsed: float):
+        """写入一条记录。先写临时文件再原子替换，避免并行分析师写出半截文件。"""
+        path = self._path(kind, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        entry = {"request": request, "response": response, "elapsed": round(elapsed, 3)}
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+            json.dump(entry, f, ensure_ascii=False, separators=(',', ':'))
+        os.replace(tmp_path, path)
+
+    def record_query(self, query: str):
+        """保存本次运行的用户查询，回放时无需重新输入。"""
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, "query.json"), 'w', encoding='utf-8') as f:
+            json.dump({"query": query}, f, ensure_ascii=False, indent=4)
+
+    def recorded_query(self):
+        """读取录制时的用户查询，不存在时返回 None。"""
+        path = os.path.join(self.directory, "query.json")
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)["query"]
+
+    def replay(self, kind: str, key: str):
+        """回放一条记录，按需模拟录制时的延迟。"""
+        entry = self.load(kind, key)
+        if entry is None:
+            raise CassetteMissError(f"磁带 {self.directory} 中没有 {kind} 记录 {key[:12]}，请先以 record 模式运行")
+        if self.latency_scale > 0:
+            time.sleep(entry.get("elapsed", 0) * self.latency_scale)
+        return entry["response"]
+
+
+class CassetteLLMCache(BaseCache):
+    """
+    基于 LangChain 缓存接口的 LLM 磁带。
+    record 模式下每次都真实调用模型并写入磁带；replay 模式下只从磁带读取。
+    """
+
+    def __init__(self, cassette: Cassette):
+        self.cassette = cassette
+        self._started = {}
+        self._lock = threading.Lock()
+
+    # 回放出来的消息会被 LangChain 改写这些字段 (例如 usage_metadata 中追加 total_cost)，
+    # 若参与寻址，ReAct 循环的后续请求将永远无法命中
+    VOLATILE_FIELDS = ("id", "usage_metadata", "response_metadata")
+    # 只影响 HTTP 传输的模型参数，与搜索的 timeout 一样不参与磁带键
+    TRANSPORT_FIELDS = ("request_timeout",)
+
+    def _llm_string(self, llm_string: str) -> str:
+        """llm_string 形如 '<模型 JSON>---<调用参数>'，去掉其中的传输参数。"""
+        model, sep, params = llm_string.partition("---")
+        try:
+            config = json.loads(model)
+        except ValueError:
+            return llm_string
+        kwargs = config.get("kwargs") if isinstance(config, dict) else None
+        if isinstance(kwargs, dict):
+            for field in self.TRANSPORT_FIELDS:
+                kwargs.pop(field, None)
+        return json.dumps(config, sort_keys=True) + sep + params
+
+    def _request(self, prompt: str, llm_string: str):
+        llm_string = self._llm_string(llm_string)
+        try:
+            messages = json.loads(prompt)
+        except ValueError:
+            return {"prompt": prompt, "llm": llm_string}
+        for message in messages if isinstance(messages, list) else []:
+            kwargs = message.get("kwargs") if isinstance(message, dict) else None
+            if isinstance(kwargs, dict):
+                for field in self.VOLATILE_FIELDS:
+                    kwargs.pop(field, None)
+        return {"prompt": messages, "llm": llm_string}
+
+    def lookup(self, prompt: str, llm_string: str):
+        key = self.cassette.key("llm", self._request(prompt, llm_string))
+        if self.cassette.mode == "replay":
+            records = self.cassette.replay("llm", key)
+            with warnings.catch_warnings():
+                # langchain_core.load.loads 仍处于 beta 阶段，这里不需要重复提示
+                warnings.simplefilter("ignore")
+                return [loads(g, allowed_objects="core") for g in records]
+        # 录制模式：记录请求开始时间，用于计算真实延迟
+        with self._lock:
+            self._started[key] = time.monotonic()
+        return None
+
+    def update(self, prompt: str, llm_string: str, return_val):
+        if self.cassette.mode != "record":
+            return
+        request = self._request(prompt, llm_string)
+        key = self.cassette.key("llm", request)
+        with self._lock:
+            started = self._started.pop(key, time.monotonic())
+        self.cassette.save("llm", key, request, [dumps(g) for g in return_val], time.monotonic() - started)
+
+    def clear(self, **kwargs):
+        with self._lock:
+            self._started.clear()
+
+
+class CassetteSearchClient:
+    """包装 TavilyClient.search，录制或回放搜索结果。"""
+
+    def __init__(self, client, cassette: Cassette):
+        self.client = client
+        self.cassette = cassette
+
+    def search(self, query: str, **kwargs):
+        # timeout 只影响传输，不参与磁带键
+        request = {"query": query, **{k: v for k, v in kwargs.items() if k != "timeout"}}
+        key = self.cassette.key("search", request)
+        if self.cassette.mode == "replay":
+            return self.cassette.replay("search", key)
+
+        started = time.monotonic()
+        response = self.client.search(query, **kwargs)
+        self.cassette.save("search", key, request, response, time.monotonic() - started)
+        return response
+
+
+def _cassette_from_env():
+    return Cassette(
+        directory=os.environ.get("FINCHAIN_CASSETTE_DIR", os.path.join("cassettes", "default")),
+        mode=os.environ.get("FINCHAIN_CASSETTE_MODE", "off").lower(),
+        latency_scale=float(os.environ.get("FINCHAIN_CASSETTE_LATENCY", "0")),
+    )
+
+
+# 全局磁带实例 (在 main.py 中 load_dotenv 之后才会被导入)
+cassette = _cassette_from_env()
+_llm_cache = CassetteLLMCache(cassette) if cassette.enabled else None
+
+
+def llm_cache():
+    """返回供 ChatOpenAI(cache=...) 使用的磁带缓存；未启用时返回 None。"""
+    return _llm_cache
+
+
+def api_key(env_name: str):
+    """读取 API Key；回放模式下不会访问网络，缺失时使用占位值。"""
+    value = os.environ.get(env_name)
+    if not value and cassette.mode == "replay":
+        return "cassette-replay"
+    return value
+
+
+_sandbox = None
+
+
+def sandbox_dir():
+    """
+    回放模式下的临时工作目录：账本、代币流水和 HTML 研报都写到这里，
+    回归测试不会改动生产账本。非回放模式返回 None。
+    """
+    global _sandbox
+    if cassette.mode != "replay":
+        return None
+    if _sandbox is None:
+        _sandbox = tempfile.mkdtemp(prefix="finchain-replay-")
+    return _sandbox
+
+
+def wrap_search_client(factory):
+    """
+    根据磁带模式包装搜索客户端。
+    回放模式下不会创建真实客户端，因此无需 TAVILY_API_KEY。
+    """
+    if cassette.mode == "replay":
+        return CassetteSearchClient(None, cassette)
+    client = factory()
+    if cassette.mode == "record":
+        return CassetteSearchClient(client, cassette)
+    return client
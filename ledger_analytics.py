@@ -0,0 +1,262 @@
+import os
+import json
+import shutil
+import argparse
+import numpy as np
+from ledger_compaction import write_json_atomic
+
+# --- 列式导出与向量化分析 (Columnar Export & Vectorized Analytics) ---
+# 把区块 (每次运行的结果) 和代币转账增量导出为按列存储的 .npy 文件：
+#   analytics/manifest.json              已导出的位置、行数、分片列表与字符串字典
+#   analytics/blocks/part-00001/<列>.npy  每次导出追加一个分片 (row group)
+#   analytics/transfers/part-00001/<列>.npy
+# 分片数达到 MAX_PARTS 时，导出会把整张表合并重写为一个分片，查询开销不随导出次数增长。
+# 字符串列 (分析师名称、状态) 采用字典编码，统一存为 int32 编码。
+# 分析查询直接在列上用 bincount / unique 计算，无需逐条解析 JSON。
+
+ANALYTICS_DIR = "analytics"
+MAX_PARTS = 16
+
+# 区块类型：由 blockchain_node 写入的运行结果，或其他来源 (测试脚本、record_on_chain 手动调用)
+KIND_RUN = 0
+KIND_OTHER = 1
+
+BLOCK_COLUMNS = {
+    "index": np.int64,
+    "timestamp": np.int64,      # Unix 秒
+    "kind": np.int8,
+    "winner": np.int32,         # 字典编码，-1 表示无
+    "status": np.int32,         # 字典编码，-1 表示无
+    "report_length": np.int32,  # 报告全文长度，-1 表示未知 (早期区块只记录了摘要)
+}
+TRANSFER_COLUMNS = {
+    "seq": np.int64,
+    "timestamp": np.int64,
+    "sender": np.int32,
+    "recipient": np.int32,
+    "amount": np.int64,
+}
+
+
+def _epoch_seconds(timestamps):
+    return np.array(timestamps, dtype='datetime64[s]').astype(np.int64)
+
+
+class ColumnStore:
+    def __init__(self, root=ANALYTICS_DIR):
+        self.root = root
+        self.manifest_file = os.path.join(root, "manifest.json")
+        self.manifest = self._load_manifest()
+        self._codes = {name: {v: i for i, v in enumerate(values)}
+                       for name, values in self.manifest["dictionaries"].items()}
+
+    def _load_manifest(self):
+        if os.path.exists(self.manifest_file):
+            with open(self.manifest_file, 'r') as f:
+                return json.load(f)
+        return {
+            "blocks": {"last_index": 0, "rows": 0, "parts": []},
+            "transfers": {"last_seq": 0, "rows": 0, "parts": []},
+            "dictionaries": {"names": [], "status": []},
+            "balances": {},
+            "next_part": 1,
+        }
+
+    def encode(self, dictionary: str, value) -> int:
+        """字典编码；新值追加到字典末尾，已有编码保持不变。"""
+        if value is None:
+            return -1
+        codes = self._codes.setdefault(dictionary, {})
+        if value not in codes:
+            codes[value] = len(codes)
+            self.manifest["dictionaries"].setdefault(dictionary, []).append(value)
+        return codes[value]
+
+    def _new_part(self, table: str, columns: dict, schema: dict) -> str:
+        # 分片编号单调递增 (合并后也不复用)，旧清单引用的分片不会被覆盖
+        number = self.manifest.get("next_part") or max(len(self.manifest[t]["parts"]) for t in ("blocks", "transfers")) + 1
+        self.manifest["next_part"] = number + 1
+        part = os.path.join(table, f"part-{number:05d}")
+        os.makedirs(os.path.join(self.root, part), exist_ok=True)
+        for name, dtype in schema.items():
+            np.save(os.path.join(self.root, part, f"{name}.npy"), np.asarray(columns[name], dtype=dtype))
+        return part
+
+    def _write_part(self, table: str, columns: dict, schema: dict):
+        self.manifest[table]["parts"].append(self._new_part(table, columns, schema))
+        self.manifest[table]["rows"] += len(columns[next(iter(schema))])
+
+    def merge_parts(self, table: str, schema: dict) -> list:
+        """
+        把一张表的全部分片重写为一个分片，返回被替换的旧分片。
+        旧分片需在清单落盘之后再删除 (见 remove_parts)，中途崩溃时清单仍指向完整的数据。
+        """
+        old_parts = self.manifest[table]["parts"]
+        if len(old_parts) <= 1:
+            return []
+        self.manifest[table]["parts"] = [self._new_part(table, self.load(table, schema), schema)]
+        return old_parts
+
+    def remove_parts(self, parts: list):
+        for part in parts:
+            shutil.rmtree(os.path.join(self.root, part), ignore_errors=True)
+
+    def load(self, table: str, schema: dict) -> dict:
+        """读取一张表的全部分片并按列拼接。"""
+        parts = self.manifest[table]["parts"]
+        if not parts:
+            return {name: np.empty(0, dtype=dtype) for name, dtype in schema.items()}
+        return {
+            name: np.concatenate([np.load(os.path.join(self.root, p, f"{name}.npy"), mmap_mode='r') for p in parts])
+            for name in schema
+        }
+
+    def save_manifest(self):
+        os.makedirs(self.root, exist_ok=True)
+        write_json_atomic(self.manifest_file, self.manifest)
+
+
+def _block_row(block, store: ColumnStore):
+    """把形态各异的区块 data 归一化为一行。"""
+    data = block.get("data") or {}
+    if data.get("report_length") is not None:
+        report_length = data["report_length"]
+    elif isinstance(data.get("report"), str):
+        report_length = len(data["report"])
+    else:
+        report_length = -1
+    return (
+        block["index"],
+        block["timestamp"],
+        KIND_RUN if "winner" in data else KIND_OTHER,
+        store.encode("names", data.get("winner")),
+        store.encode("status", data.get("status") or data.get("audit_result")),
+        report_length,
+    )
+
+
+def export(backend, store: ColumnStore, max_parts=MAX_PARTS):
+    """
+    增量导出：只处理上次导出之后的新区块与新转账，各写成一个新分片。
+    某张表的分片数超过 max_parts 时合并为一个分片，并记录导出时刻的余额。
+    """
+    rows = [_block_row(b, store) for b in backend.iter_blocks(store.manifest["blocks"]["last_index"] + 1)]
+    if rows:
+        columns = dict(zip(BLOCK_COLUMNS, map(list, zip(*rows))))
+        columns["timestamp"] = _epoch_seconds(columns["timestamp"])
+        store._write_part("blocks", columns, BLOCK_COLUMNS)
+        store.manifest["blocks"]["last_index"] = int(columns["index"][-1])
+
+    transfers = list(backend.iter_transfers(store.manifest["transfers"]["last_seq"]))
+    if transfers:
+        columns = {
+            "seq": [t["seq"] for t in transfers],
+            "timestamp": _epoch_seconds([t["timestamp"] for t in transfers]),
+            "sender": [store.encode("names", t["from"]) for t in transfers],
+            "recipient": [store.encode("names", t["to"]) for t in transfers],
+            "amount": [t["amount"] for t in transfers],
+        }
+        store._write_part("transfers", columns, TRANSFER_COLUMNS)
+        store.manifest["transfers"]["last_seq"] = int(columns["seq"][-1])
+
+    merged = []
+    for table, schema in (("blocks", BLOCK_COLUMNS), ("transfers", TRANSFER_COLUMNS)):
+        if len(store.manifest[table]["parts"]) > max_parts:
+            merged += store.merge_parts(table, schema)
+    # 转账流水只覆盖引入流水之后的奖励，累计收入以余额为准
+    store.manifest["balances"] = backend.balances()
+    store.save_manifest()
+    store.remove_parts(merged)
+    return len(rows), len(transfers)
+
+
+# --- 向量化分析 ---
+
+def period_start(timestamps, freq: str):
+    """把 Unix 秒对齐到周期起点 (D: 天, W: 周一, M: 月)，返回 datetime64[D]。"""
+    days = timestamps // 86400
+    if freq == "D":
+        return days.astype('datetime64[D]')
+    if freq == "W":
+        # 1970-01-01 是周四，+3 后对 7 取余即为距周一的天数
+        return (days - (days + 3) % 7).astype('datetime64[D]')
+    if freq == "M":
+        return days.astype('datetime64[D]').astype('datetime64[M]').astype('datetime64[D]')
+    raise ValueError(f"未知的周期: {freq}，可选值: D, W, M")
+
+
+def leaderboard(blocks: dict, transfers: dict, names: list, balances=None):
+    """
+    每位分析师的获胜次数、胜率、流水中获得的 FCA 与导出时的余额，按获胜次数降序。
+    earned 只统计转账流水 (引入流水之前的奖励不在其中)；balance 来自导出时的账本余额。
+    """
+    balances = balances or {}
+    runs = blocks["kind"] == KIND_RUN
+    winners = blocks["winner"][runs]
+    wins = np.bincount(winners[winners >= 0], minlength=len(names))
+    earned = np.bincount(transfers["recipient"], weights=transfers["amount"], minlength=len(names))
+    total_runs = max(int(runs.sum()), 1)
+    order = np.lexsort((-earned, -wins))
+    return [
+        {"agent": names[i], "wins": int(wins[i]), "win_rate": float(wins[i] / total_runs),
+         "earned": int(earned[i]), "balance": balances.get(names[i])}
+        for i in order if wins[i] or earned[i]
+    ]
+
+
+def report_length_by_period(blocks: dict, freq="W"):
+    """按周期统计报告数量与平均长度 (忽略长度未知的区块)。"""
+    known = blocks["report_length"] >= 0
+    periods, inverse = np.unique(period_start(blocks["timestamp"][known], freq), return_inverse=True)
+    counts = np.bincount(inverse, minlength=len(periods))
+    totals = np.bincount(inverse, weights=blocks["report_length"][known], minlength=len(periods))
+    return periods, counts, totals / np.maximum(counts, 1)
+
+
+def earnings_by_period(transfers: dict, names: list, freq="W"):
+    """按周期与收款方汇总 FCA，返回 (周期, 金额矩阵[周期, 名称])。"""
+    periods, inverse = np.unique(period_start(transfers["timestamp"], freq), return_inverse=True)
+    n = len(names)
+    flat = np.bincount(inverse * n + transfers["recipient"], weights=transfers["amount"],
+                       minlength=len(periods) * n)
+    return periods, flat.reshape(len(periods), n)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="FinChain 账本列式导出与统计")
+    parser.add_argument("--dir", default=ANALYTICS_DIR, help="列式数据目录")
+    sub = parser.add_subparsers(dest="command", required=True)
+    export_cmd = sub.add_parser("export", help="增量导出区块与转账")
+    export_cmd.add_argument("--backend", default=None, help="json 或 sqlite，默认读取 FINCHAIN_LEDGER_BACKEND")
+    sub.add_parser("leaderboard", help="分析师排行榜")
+    weekly_cmd = sub.add_parser("report-length", help="各周期报告平均长度")
+    weekly_cmd.add_argument("--freq", default="W", choices=["D", "W", "M"])
+    earnings_cmd = sub.add_parser("earnings", help="各周期 FCA 收入")
+    earnings_cmd.add_argument("--freq", default="W", choices=["D", "W", "M"])
+    args = parser.parse_args()
+
+    store = ColumnStore(args.dir)
+    names = store.manifest["dictionaries"]["names"]
+
+    if args.command == "export":
+        from ledger_backend import open_backend
+        blocks, transfers = export(open_backend(args.backend, readonly=True), store)
+        print(f"导出完成: 新增 {blocks} 个区块，{transfers} 条转账 -> {args.dir}")
+    elif args.command == "leaderboard":
+        blocks, transfers = store.load("blocks", BLOCK_COLUMNS), store.load("transfers", TRANSFER_COLUMNS)
+        print(f"{'智能体':<16}{'获胜':>8}{'胜率':>8}{'流水FCA':>10}{'余额':>10}")
+        for row in leaderboard(blocks, transfers, names, store.manifest.get("balances")):
+            balance = "-" if row["balance"] is None else row["balance"]
+            print(f"{row['agent']:<16}{row['wins']:>8}{row['win_rate']:>8.1%}{row['earned']:>10}{balance:>10}")
+        print("流水FCA: 引入转账流水之后获得的 FCA；余额: 最近一次导出时的账本余额 (含更早的奖励)")
+    elif args.command == "report-length":
+        periods, counts, means = report_length_by_period(store.load("blocks", BLOCK_COLUMNS), args.freq)
+        print(f"{'周期起点':<12}{'报告数':>8}{'平均长度':>10}")
+        for period, count, mean in zip(periods, counts, means):
+            print(f"{str(period):<12}{count:>8}{mean:>10.0f}")
+    else:
+        periods, matrix = earnings_by_period(store.load("transfers", TRANSFER_COLUMNS), names, args.freq)
+        active = np.flatnonzero(matrix.sum(axis=0))
+        print(f"{'周期起点':<12}" + "".join(f"{names[i]:>14}" for i in active))
+        for period, row in zip(periods, matrix):
+            print(f"{str(period):<12}" + "".join(f"{int(row[i]):>14}" for i in active))
@@ -0,0 +1,464 @@
+import os
+import json
+import sqlite3
+import argparse
+import threading
+from utils import calculate_hash, get_timestamp
+from ledger_compaction import (
+    BlobStore, compact, load_snapshot, read_archive, write_json_atomic,
+    SNAPSHOT_FILE, TOKEN_JOURNAL_FILE, BLOB_DIR, ARCHIVE_DIR,
+)
+
+# --- 账本存储后端 (Ledger Storage Backends) ---
+# BlockchainMock 与 TokenManager 共用同一个存储接口：
+#   json   默认，沿用 blockchain_ledger.json / token_ledger.json (+ 快照与流水)，仅适合单进程
+#   sqlite WAL 模式的 SQLite 数据库，支持多个图运行与审计工具并发读写
+# 通过 FINCHAIN_LEDGER_BACKEND 与 FINCHAIN_LEDGER_DB 选择。
+
+# 初始分配：系统 DAO 拥有 100万 FCA
+INITIAL_BALANCES = {"AnalystAgent": 0, "AuditAgent": 0, "SystemDAO": 1000000}
+
+# JSON 后端默认的自动压缩阈值 (尾部区块数或未折叠的转账流水数)
+COMPACT_EVERY = 100
+
+
+def make_block(index: int, data: dict, previous_hash: str) -> dict:
+    """创建区块并计算哈希。"""
+    block = {
+        "index": index,
+        "timestamp": get_timestamp(),
+        "data": data,
+        "previous_hash": previous_hash,
+    }
+    block["hash"] = calculate_hash(block)
+    return block
+
+
+def make_transfer(sender: str, recipient: str, amount: int, reason: str) -> dict:
+    return {"timestamp": get_timestamp(), "from": sender, "to": recipient, "amount": amount, "reason": reason}
+
+
+class LedgerBackend:
+    """区块链与代币账本的存储接口。"""
+
+    # --- 区块 ---
+    def head(self):
+        """返回 (链高度, 链头哈希)，空链为 (0, "0")。"""
+        raise NotImplementedError
+
+    def append_block(self, data: dict) -> dict:
+        """在链头之后追加一个区块并返回它。"""
+        raise NotImplementedError
+
+    def iter_blocks(self, start: int = 1):
+        """按高度顺序遍历 index >= start 的完整区块。"""
+        raise NotImplementedError
+
+    # --- 代币 ---
+    def balances(self) -> dict:
+        raise NotImplementedError
+
+    def get_balance(self, agent_name: str) -> int:
+        return self.balances().get(agent_name, 0)
+
+    def transfer(self, sender: str, recipient: str, amount: int, reason: str) -> int:
+        """记录一笔转账，返回收款方的新余额。"""
+        raise NotImplementedError
+
+    def iter_transfers(self, after_seq: int = 0):
+        """按序号遍历 seq > after_seq 的转账记录。"""
+        raise NotImplementedError
+
+
+class JsonLedgerBackend(LedgerBackend):
+    """
+    基于 JSON 文件的后端：启动时加载签名快照 + 尾部区块 + 快照之后的转账流水。
+    进程内用锁串行化写入，但不支持多进程并发写。
+    尾部区块数或未折叠的转账流水数达到 compact_every 时自动压缩，使启动开销不随历史增长
+    (默认读取 FINCHAIN_COMPACT_EVERY，未设置时为 COMPACT_EVERY；0 表示关闭，只能手动执行 ledger_compaction.py)。
+    """
+
+    def __init__(self, chain_file="blockchain_ledger.json", balances_file="token_ledger.json",
+                 journal_file=TOKEN_JOURNAL_FILE, snapshot_file=SNAPSHOT_FILE, blobs=None,
+                 archive_dir=ARCHIVE_DIR, compact_every=None):
+        self.chain_file = chain_file
+        self.balances_file = balances_file
+        self.journal_file = journal_file
+        self.snapshot_file = snapshot_file
+        self.blobs = blobs or BlobStore()
+        self.archive_dir = archive_dir
+        if compact_every is None:
+            compact_every = int(os.environ.get("FINCHAIN_COMPACT_EVERY", COMPACT_EVERY))
+        self.compact_every = compact_every
+        self._lock = threading.Lock()
+        # 若已压缩，快照记录了归档部分的链头，self.chain 只保存之后的尾部
+        self.snapshot = load_snapshot(snapshot_file)
+        self.chain = self._load_chain()
+        self.seq = 0
+        self._balances = self._load_balances()
+
+    # --- 加载 ---
+    def _load_chain(self):
+        if os.path.exists(self.chain_file):
+            try:
+                with open(self.chain_file, 'r') as f:
+                    return [b for b in json.load(f) if b["index"] > self.base_height]
+            except:
+                pass
+        return []
+
+    def _load_balances(self):
+        balances = None
+        if self.snapshot:
+            balances = dict(self.snapshot["tokens"]["balances"])
+            self.seq = self.snapshot["tokens"]["journal_seq"]
+        elif os.path.exists(self.balances_file):
+            try:
+                with open(self.balances_file, 'r') as f:
+                    balances = json.load(f)
+            except:
+                pass
+        if balances is None:
+            balances = dict(INITIAL_BALANCES)
+
+        for entry in self.read_journal():
+            self._apply(balances, entry)
+            self.seq = entry["seq"]
+        return balances
+
+    @property
+    def base_height(self):
+        return self.snapshot["chain"]["height"] if self.snapshot else 0
+
+    @property
+    def base_hash(self):
+        return self.snapshot["chain"]["head_hash"] if self.snapshot else "0"
+
+    @property
+    def journal_seq(self):
+        return self.snapshot["tokens"]["journal_seq"] if self.snapshot else 0
+
+    # --- 区块 ---
+    def head(self):
+        if self.chain:
+            return self.chain[-1]["index"], self.chain[-1]["hash"]
+        return self.base_height, self.base_hash
+
+    def append_block(self, data: dict) -> dict:
+        with self._lock:
+            height, head_hash = self.head()
+            block = make_block(height + 1, data, head_hash)
+            self.chain.append(block)
+            self.save_chain()
+            self._maybe_compact()
+            return block
+
+    def _maybe_compact(self):
+        """尾部超过阈值时自动压缩 (调用方需持有 self._lock)。"""
+        if not self.compact_every:
+            return
+        if len(self.chain) >= self.compact_every or self.seq - self.journal_seq >= self.compact_every:
+            compact(self, keep_tail=0)
+
+    def save_chain(self):
+        with open(self.chain_file, 'w') as f:
+            json.dump(self.chain, f, indent=4)
+
+    def block_with_data(self, block: dict):
+        """压缩后的区块只保留 data_ref，这里从 BlobStore 还原出原始区块"""
+        if "data_ref" not in block:
+            return block
+        restored = {k: v for k, v in block.items() if k != "data_ref"}
+        restored["data"] = self.blobs.get(block["data_ref"])
+        return restored
+
+    def iter_blocks(self, start: int = 1):
+        for segment in (self.snapshot or {}).get("chain", {}).get("segments", []):
+            # 段文件名形如 blocks_<起始>_<结束>.json.gz，可跳过整段
+            if int(os.path.basename(segment).split("_")[2].split(".")[0]) < start:
+                continue
+            for block in read_archive(segment):
+                if block["index"] >= start:
+                    yield self.block_with_data(block)
+        for block in list(self.chain):
+            if block["index"] >= start:
+                yield self.block_with_data(block)
+
+    # --- 代币 ---
+    def _apply(self, balances, entry):
+        balances.setdefault(entry["to"], 0)
+        balances[entry["to"]] += entry["amount"]
+        balances[entry["from"]] = balances.get(entry["from"], 0) - entry["amount"]
+
+    def read_journal(self):
+        """读取快照之后的转账流水"""
+        entries = []
+        if os.path.exists(self.journal_file):
+            with open(self.journal_file, 'r') as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    entry = json.loads(line)
+                    if entry["seq"] > self.journal_seq:
+                        entries.append(entry)
+        return entries
+
+    def truncate_journal(self):
+        open(self.journal_file, 'w').close()
+
+    def save_balances(self):
+        write_json_atomic(self.balances_file, self._balances)
+
+    def balances(self) -> dict:
+        return dict(self._balances)
+
+    def transfer(self, sender: str, recipient: str, amount: int, reason: str) -> int:
+        """追加一条转账流水，不再整体重写账本"""
+        with self._lock:
+            self.seq += 1
+            entry = {"seq": self.seq, **make_transfer(sender, recipient, amount, reason)}
+            self._apply(self._balances, entry)
+            with open(self.journal_file, 'a') as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            self._maybe_compact()
+            return self._balances[recipient]
+
+    def iter_transfers(self, after_seq: int = 0):
+        for segment in (self.snapshot or {}).get("tokens", {}).get("segments", []):
+            if int(os.path.basename(segment).split("_")[2].split(".")[0]) <= after_seq:
+                continue
+            for entry in read_archive(segment):
+                if entry["seq"] > after_seq:
+                    yield entry
+        for entry in self.read_journal():
+            if entry["seq"] > after_seq:
+                yield entry
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS blocks (
+    idx           INTEGER PRIMARY KEY,
+    timestamp     TEXT NOT NULL,
+    data          TEXT NOT NULL,
+    previous_hash TEXT NOT NULL,
+    hash          TEXT NOT NULL UNIQUE
+);
+CREATE INDEX IF NOT EXISTS blocks_timestamp ON blocks(timestamp);
+
+-- 哈希链约束：新区块必须紧接链头，且 previous_hash 必须等于链头哈希
+CREATE TRIGGER IF NOT EXISTS blocks_extend_head BEFORE INSERT ON blocks
+BEGIN
+    SELECT RAISE(ABORT, 'block index must extend the chain head')
+     WHERE NEW.idx != COALESCE((SELECT MAX(idx) FROM blocks), 0) + 1;
+    SELECT RAISE(ABORT, 'previous_hash does not match the chain head')
+     WHERE NEW.previous_hash != COALESCE((SELECT hash FROM blocks WHERE idx = NEW.idx - 1), '0');
+END;
+CREATE TRIGGER IF NOT EXISTS blocks_no_update BEFORE UPDATE ON blocks
+BEGIN
+    SELECT RAISE(ABORT, 'blocks are append-only');
+END;
+CREATE TRIGGER IF NOT EXISTS blocks_no_delete BEFORE DELETE ON blocks
+BEGIN
+    SELECT RAISE(ABORT, 'blocks are append-only');
+END;
+
+CREATE TABLE IF NOT EXISTS transfers (
+    seq       INTEGER PRIMARY KEY,
+    timestamp TEXT NOT NULL,
+    sender    TEXT NOT NULL,
+    recipient TEXT NOT NULL,
+    amount    INTEGER NOT NULL,
+    reason    TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS transfers_recipient ON transfers(recipient, seq);
+CREATE INDEX IF NOT EXISTS transfers_sender ON transfers(sender, seq);
+
+CREATE TABLE IF NOT EXISTS balances (
+    agent   TEXT PRIMARY KEY,
+    balance INTEGER NOT NULL
+);
+"""
+
+
+class SqliteLedgerBackend(LedgerBackend):
+    """
+    WAL 模式的 SQLite 后端。
+    每个线程使用独立连接；写操作以 BEGIN IMMEDIATE 串行化 (跨进程同样有效)，
+    读操作不会被写阻塞，适合报告查看器、校验脚本等并发读者。
+    """
+
+    def __init__(self, path="finchain_ledger.db", readonly=False):
+        self.path = path
+        self.readonly = readonly
+        self._local = threading.local()
+        if not readonly:
+            conn = self._conn()
+            conn.executescript(SQLITE_SCHEMA)
+            if conn.execute("SELECT COUNT(*) FROM balances").fetchone()[0] == 0:
+                self._write(lambda c: c.executemany(
+                    "INSERT OR IGNORE INTO balances(agent, balance) VALUES (?, ?)", INITIAL_BALANCES.items()))
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            if self.readonly:
+                conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, timeout=30, isolation_level=None)
+            else:
+                conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=30000")
+            self._local.conn = conn
+        return conn
+
+    def _write(self, fn):
+        """在写事务中执行 fn(conn)；BEGIN IMMEDIATE 保证读链头与写入之间没有其他写者。"""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = fn(conn)
+            conn.execute("COMMIT")
+            return result
+        except:
+            conn.execute("ROLLBACK")
+            raise
+
+    @staticmethod
+    def _row_to_block(row):
+        idx, timestamp, data, previous_hash, block_hash = row
+        return {"index": idx, "timestamp": timestamp, "data": json.loads(data),
+                "previous_hash": previous_hash, "hash": block_hash}
+
+    # --- 区块 ---
+    def head(self):
+        row = self._conn().execute("SELECT idx, hash FROM blocks ORDER BY idx DESC LIMIT 1").fetchone()
+        return (row[0], row[1]) if row else (0, "0")
+
+    def _insert_block(self, conn, block):
+        if calculate_hash({k: v for k, v in block.items() if k != "hash"}) != block["hash"]:
+            raise ValueError(f"区块 #{block['index']} 哈希不匹配")
+        conn.execute(
+            "INSERT INTO blocks(idx, timestamp, data, previous_hash, hash) VALUES (?, ?, ?, ?, ?)",
+            (block["index"], block["timestamp"], json.dumps(block["data"], ensure_ascii=False),
+             block["previous_hash"], block["hash"]))
+
+    def append_block(self, data: dict) -> dict:
+        def append(conn):
+            row = conn.execute("SELECT idx, hash FROM blocks ORDER BY idx DESC LIMIT 1").fetchone()
+            height, head_hash = (row[0], row[1]) if row else (0, "0")
+            block = make_block(height + 1, data, head_hash)
+            self._insert_block(conn, block)
+            return block
+        return self._write(append)
+
+    def iter_blocks(self, start: int = 1):
+        cursor = self._conn().execute(
+            "SELECT idx, timestamp, data, previous_hash, hash FROM blocks WHERE idx >= ? ORDER BY idx", (start,))
+        for row in cursor:
+            yield self._row_to_block(row)
+
+    # --- 代币 ---
+    def balances(self) -> dict:
+        return dict(self._conn().execute("SELECT agent, balance FROM balances").fetchall())
+
+    def get_balance(self, agent_name: str) -> int:
+        row = self._conn().execute("SELECT balance FROM balances WHERE agent = ?", (agent_name,)).fetchone()
+        return row[0] if row else 0
+
+    def _insert_transfer(self, conn, entry):
+        conn.execute(
+            "INSERT INTO transfers(seq, timestamp, sender, recipient, amount, reason) VALUES (?, ?, ?, ?, ?, ?)",
+            (entry.get("seq"), entry["timestamp"], entry["from"], entry["to"], entry["amount"], entry["reason"]))
+
+    def transfer(self, sender: str, recipient: str, amount: int, reason: str) -> int:
+        def apply(conn):
+            self._insert_transfer(conn, make_transfer(sender, recipient, amount, reason))
+            for agent, delta in ((sender, -amount), (recipient, amount)):
+                conn.execute(
+                    "INSERT INTO balances(agent, balance) VALUES (?, ?) "
+                    "ON CONFLICT(agent) DO UPDATE SET balance = balance + excluded.balance", (agent, delta))
+            return conn.execute("SELECT balance FROM balances WHERE agent = ?", (recipient,)).fetchone()[0]
+        return self._write(apply)
+
+    def iter_transfers(self, after_seq: int = 0):
+        cursor = self._conn().execute(
+            "SELECT seq, timestamp, sender, recipient, amount, reason FROM transfers WHERE seq > ? ORDER BY seq",
+            (after_seq,))
+        for seq, timestamp, sender, recipient, amount, reason in cursor:
+            yield {"seq": seq, "timestamp": timestamp, "from": sender, "to": recipient,
+                   "amount": amount, "reason": reason}
+
+    def migrate_from(self, source: LedgerBackend):
+        """
+        从其他后端 (通常是 JSON 账本) 导入全部区块、转账历史与当前余额。
+        区块逐个校验哈希并经过哈希链触发器；目标库必须为空。
+        """
+        def migrate(conn):
+            if conn.execute("SELECT COUNT(*) FROM blocks").fetchone()[0]:
+                raise ValueError(f"{self.path} 中已有区块，拒绝重复迁移")
+            blocks = transfers = 0
+            for block in source.iter_blocks():
+                self._insert_block(conn, block)
+                blocks += 1
+            for entry in source.iter_transfers():
+                self._insert_transfer(conn, entry)
+                transfers += 1
+            # 历史转账在 JSON 账本中并不完整 (早期只保存余额)，因此直接导入当前余额
+            conn.execute("DELETE FROM balances")
+            conn.executemany("INSERT INTO balances(agent, balance) VALUES (?, ?)", source.balances().items())
+            return blocks, transfers
+        return self._write(migrate)
+
+
+def verify_chain(backend: LedgerBackend):
+    """重新计算全部区块哈希并校验链接关系，返回 (是否有效, 区块数)。"""
+    previous_hash, count = "0", 0
+    for block in backend.iter_blocks():
+        body = {k: v for k, v in block.items() if k != "hash"}
+        if block["previous_hash"] != previous_hash or calculate_hash(body) != block["hash"]:
+            print(f"  [校验] 区块 #{block['index']} 校验失败")
+            return False, count
+        previous_hash, count = block["hash"], count + 1
+    return True, count
+
+
+def open_backend(kind=None, readonly=False, root=None) -> LedgerBackend:
+    """
+    根据 FINCHAIN_LEDGER_BACKEND 打开账本后端。
+    指定 root 时，所有账本文件都放在该目录下 (例如磁带回放使用的临时目录)。
+    """
+    kind = (kind or os.environ.get("FINCHAIN_LEDGER_BACKEND", "json")).lower()
+    if kind == "sqlite":
+        path = os.environ.get("FINCHAIN_LEDGER_DB", "finchain_ledger.db")
+        if root:
+            path = os.path.join(root, os.path.basename(path))
+        return SqliteLedgerBackend(path, readonly=readonly)
+    if kind == "json":
+        if root:
+            return JsonLedgerBackend(
+                chain_file=os.path.join(root, "blockchain_ledger.json"),
+                balances_file=os.path.join(root, "token_ledger.json"),
+                journal_file=os.path.join(root, TOKEN_JOURNAL_FILE),
+                snapshot_file=os.path.join(root, SNAPSHOT_FILE),
+                blobs=BlobStore(os.path.join(root, BLOB_DIR)),
+                archive_dir=os.path.join(root, ARCHIVE_DIR),
+            )
+        return JsonLedgerBackend()
+    raise ValueError(f"未知的账本后端: {kind}，可选值: json, sqlite")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="FinChain 账本后端工具")
+    sub = parser.add_subparsers(dest="command", required=True)
+    migrate_cmd = sub.add_parser("migrate", help="将 JSON 账本迁移到 SQLite")
+    migrate_cmd.add_argument("--db", default=os.environ.get("FINCHAIN_LEDGER_DB", "finchain_ledger.db"))
+    verify_cmd = sub.add_parser("verify", help="以只读方式校验区块链")
+    verify_cmd.add_argument("--backend", default=None, help="json 或 sqlite，默认读取 FINCHAIN_LEDGER_BACKEND")
+    args = parser.parse_args()
+
+    if args.command == "migrate":
+        blocks, transfers = SqliteLedgerBackend(args.db).migrate_from(JsonLedgerBackend())
+        print(f"迁移完成: {blocks} 个区块，{transfers} 条转账 -> {args.db}")
+    else:
+        ok, count = verify_chain(open_backend(args.backend, readonly=True))
+        print(f"校验{'通过' if ok else '失败'}: 共 {count} 个区块")
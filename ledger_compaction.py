@@ -0,0 +1,190 @@
+import os
+import gzip
+import hmac
+import json
+import hashlib
+import argparse
+from utils import calculate_hash, get_timestamp
+
+# --- 账本快照与压缩 (Ledger Snapshot & Compaction) ---
+# 压缩后的账本布局：
+#   ledger_blobs/       区块负载的内容寻址存储 (gzip JSON)，链上只保留 data_ref 哈希
+#   ledger_archive/     已归档的历史区块段和转账流水段 (gzip)
+#   ledger_snapshot.json 链头与余额的签名快照
+#   blockchain_ledger.json / token_journal.jsonl 只保存快照之后的尾部
+# 启动时只需加载最新快照和尾部，内存与启动时间不随历史增长。
+
+SNAPSHOT_FILE = "ledger_snapshot.json"
+BLOB_DIR = "ledger_blobs"
+ARCHIVE_DIR = "ledger_archive"
+TOKEN_JOURNAL_FILE = "token_journal.jsonl"
+
+
+def write_json_atomic(path: str, obj, indent=4):
+    """先写临时文件再替换，避免中途崩溃留下损坏的账本。"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(obj, f, indent=indent)
+    os.replace(tmp_path, path)
+
+
+class BlobStore:
+    """按 SHA256 寻址的区块负载存储，相同内容只保存一份。"""
+
+    def __init__(self, root=BLOB_DIR):
+        self.root = root
+
+    def _path(self, blob_hash: str) -> str:
+        return os.path.join(self.root, blob_hash[:2], f"{blob_hash}.json.gz")
+
+    def put(self, data) -> str:
+        blob_hash = calculate_hash(data)
+        path = self._path(blob_hash)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with gzip.open(f"{path}.tmp", 'wt', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False, sort_keys=True)
+            os.replace(f"{path}.tmp", path)
+        return blob_hash
+
+    def get(self, blob_hash: str):
+        with gzip.open(self._path(blob_hash), 'rt', encoding='utf-8') as f:
+            return json.load(f)
+
+
+# --- 快照签名 ---
+
+def _signing_key():
+    key = os.environ.get("FINCHAIN_LEDGER_KEY")
+    return key.encode('utf-8') if key else None
+
+
+def _digest(payload: dict, key):
+    body = json.dumps(payload, sort_keys=True).encode('utf-8')
+    if key:
+        return "hmac-sha256", hmac.new(key, body, hashlib.sha256).hexdigest()
+    # 未配置密钥时仅做完整性校验
+    return "sha256", hashlib.sha256(body).hexdigest()
+
+
+def sign_snapshot(payload: dict) -> dict:
+    alg, value = _digest(payload, _signing_key())
+    return {**payload, "signature": {"alg": alg, "value": value}}
+
+
+def load_snapshot(path=SNAPSHOT_FILE):
+    """
+    加载并校验快照；不存在时返回 None，签名不符时抛出 ValueError。
+    设置了 FINCHAIN_LEDGER_KEY 时只接受 HMAC 签名，防止把签名类型降级为 sha256 后伪造快照。
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        snapshot = json.load(f)
+    payload = {k: v for k, v in snapshot.items() if k != "signature"}
+    signature = snapshot.get("signature", {})
+    key = _signing_key()
+    if key and signature.get("alg") != "hmac-sha256":
+        raise ValueError(f"已设置 FINCHAIN_LEDGER_KEY，但快照 {path} 未使用 HMAC 签名 ({signature.get('alg')})，拒绝加载")
+    if signature.get("alg") == "hmac-sha256" and key is None:
+        raise ValueError(f"快照 {path} 使用 HMAC 签名，但未设置 FINCHAIN_LEDGER_KEY")
+    _, expected = _digest(payload, key)
+    if not hmac.compare_digest(expected, signature.get("value", "")):
+        raise ValueError(f"快照 {path} 签名校验失败，账本可能已被篡改")
+    return snapshot
+
+
+# --- 压缩 ---
+
+def _archive(path: str, records):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with gzip.open(f"{path}.tmp", 'wt', encoding='utf-8') as f:
+        json.dump(records, f, ensure_ascii=False)
+    os.replace(f"{path}.tmp", path)
+
+
+def read_archive(path: str):
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def compact(backend, keep_tail=10, archive_dir=None):
+    """
+    压缩 JSON 账本后端 (JsonLedgerBackend)：
+    1. 把所有区块的 data 移入 BlobStore，链上只保留 data_ref。
+    2. 除最近 keep_tail 个区块外，其余区块归档为 gzip 段。
+    3. 把代币流水折叠进余额，并归档已折叠的流水。
+    4. 写入新的签名快照。
+    通过命令行手动执行时，需在没有图运行时进行 (与 main.py 不共享进程内状态)；
+    进程内的自动压缩见 JsonLedgerBackend(compact_every=...)。
+    """
+    archive_dir = archive_dir or backend.archive_dir
+    previous = backend.snapshot or {}
+
+    # 生成新的区块字典，不修改调用方 (例如 append_block 的返回值) 持有的区块
+    backend.chain = [
+        {**{k: v for k, v in block.items() if k != "data"}, "data_ref": backend.blobs.put(block["data"])}
+        if "data" in block else block
+        for block in backend.chain
+    ]
+
+    split = max(len(backend.chain) - keep_tail, 0)
+    archived, tail = backend.chain[:split], backend.chain[split:]
+    block_segments = list(previous.get("chain", {}).get("segments", []))
+    if archived:
+        segment = os.path.join(archive_dir, f"blocks_{archived[0]['index']:08d}_{archived[-1]['index']:08d}.json.gz")
+        _archive(segment, archived)
+        block_segments.append(segment)
+        base_height, base_hash = archived[-1]["index"], archived[-1]["hash"]
+    else:
+        base_height, base_hash = backend.base_height, backend.base_hash
+
+    journal = backend.read_journal()
+    transfer_segments = list(previous.get("tokens", {}).get("segments", []))
+    if journal:
+        segment = os.path.join(archive_dir, f"transfers_{journal[0]['seq']:08d}_{journal[-1]['seq']:08d}.json.gz")
+        _archive(segment, journal)
+        transfer_segments.append(segment)
+
+    snapshot = sign_snapshot({
+        "version": 1,
+        "created_at": get_timestamp(),
+        "chain": {
+            "height": base_height,
+            "head_hash": base_hash,
+            "segments": block_segments,
+        },
+        "tokens": {
+            "balances": backend.balances(),
+            "journal_seq": backend.seq,
+            "segments": transfer_segments,
+        },
+    })
+    # 先落盘快照，再截断尾部；中途崩溃时重复的尾部记录会按序号/高度被跳过
+    write_json_atomic(backend.snapshot_file, snapshot)
+    backend.snapshot = snapshot
+    backend.chain = tail
+    backend.save_chain()
+    backend.truncate_journal()
+    backend.save_balances()
+    return snapshot
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="FinChain 账本快照与压缩工具")
+    sub = parser.add_subparsers(dest="command", required=True)
+    compact_cmd = sub.add_parser("compact", help="归档历史区块并生成签名快照")
+    compact_cmd.add_argument("--keep-tail", type=int, default=10, help="保留在活动账本中的最近区块数")
+    sub.add_parser("verify", help="校验完整区块链 (含归档段)")
+    args = parser.parse_args()
+
+    from ledger_backend import JsonLedgerBackend, verify_chain
+
+    # 快照与压缩只适用于 JSON 后端；SQLite 后端按索引读取，无需整体加载
+    backend = JsonLedgerBackend()
+    if args.command == "compact":
+        snapshot = compact(backend, keep_tail=args.keep_tail)
+        print(f"已生成快照: 链高度 {snapshot['chain']['height']}，流水序号 {snapshot['tokens']['journal_seq']}")
+    else:
+        ok, count = verify_chain(backend)
+        print(f"校验{'通过' if ok else '失败'}: 共 {count} 个区块")
@@ -8,9 +8,16 @@ from typing import TypedDict, Annotated, List, Union, Dict
 from langgraph.graph import StateGraph, END
 from langchain_core.messages import BaseMessage, HumanMessage, AIMessage, ToolMessage
 from agents import analyst_a, analyst_b, analyst_c, auditor_agent, llm
-from tools import tavily_search, record_on_chain, token_manager
+from model_router import router
+from tools import tavily_search, record_on_chain, token_manager, TOOL_TIMEOUT_SECONDS
 from html_generator import generate_html_report
+from utils import parse_json_block
+from prompts import analyst_messages, auditor_messages
+from cassette import cassette, sandbox_dir, CassetteMissError
 import operator
+import time
+from concurrent.futures import wait
+from langchain_core.runnables.config import ContextThreadPoolExecutor
 
 # --- 定义图的状态 (State) ---
 # AgentState 用于在图中的各个节点之间传递数据
@@ -37,6 +44,64 @@ class AgentState(TypedDict):
     final_report: str    # 最终获胜的报告全文
     block_hash: str      # 上链后的区块哈希值
 
+# --- 工具执行与时间预算 ---
+# 每位分析师每轮的总时间预算 (秒)；单次搜索的超时 TOOL_TIMEOUT_SECONDS 定义在 tools.py
+ANALYST_BUDGET_SECONDS = float(os.environ.get("FINCHAIN_ANALYST_BUDGET", "180"))
+
+# 模型调用与工具调用使用各自的线程池，避免挂起的搜索占满线程、饿死模型调用 (反之亦然)。
+# ContextThreadPoolExecutor 会把 contextvars (LangChain 的回调与追踪上下文) 带入工作线程。
+# 超时的任务会在后台运行到各自的 HTTP 超时为止，但不再阻塞分析师。
+model_executor = ContextThreadPoolExecutor(max_workers=8, thread_name_prefix="finchain-model")
+tool_executor = ContextThreadPoolExecutor(max_workers=16, thread_name_prefix="finchain-tool")
+
+def run_tool_calls(name, tool_calls, deadline):
+    """
+    并发执行一次模型响应中的全部工具调用。
+    每个调用最多等待 TOOL_TIMEOUT_SECONDS，且不超过分析师的剩余预算；
+    超时或出错的调用会返回说明文字，保证每个 tool_call 都有对应的 ToolMessage。
+    """
+    futures = {}
+    for tool_call in tool_calls:
+        if tool_call['name'] == 'tavily_search':
+            print(f"    [分析师 {name}] 正在搜索: {tool_call['args']['query']}")
+            futures[tool_call['id']] = tool_executor.submit(tavily_search.invoke, tool_call['args']['query'])
+    
+    wait(futures.values(), timeout=max(min(TOOL_TIMEOUT_SECONDS, deadline - time.monotonic()), 0))
+    
+    results = []
+    for tool_call in tool_calls:
+        future = futures.get(tool_call['id'])
+        if future is None:
+            res = f"未知工具: {tool_call['name']}"
+        elif future.done():
+            try:
+                res = future.result()
+            except CassetteMissError:
+                raise
+            except Exception as e:
+                res = str(e)
+        else:
+            future.cancel()
+            print(f"    [分析师 {name}] 搜索超时: {tool_call['args']['query']}")
+            res = "搜索超时，请基于已有信息继续分析。"
+        
+        results.append(ToolMessage(
+            tool_call_id=tool_call['id'], 
+            name=tool_call['name'], 
+            content=str(res)
+        ))
+    return results
+
+def best_report(name, messages, state, report_key):
+    """
+    预算耗尽时的降级方案：本轮最新的非空回答 > 上一轮报告 > 占位说明。
+    带 tool_calls 的响应只是搜索前的思考过程，不能当作报告。
+    """
+    for message in reversed(messages):
+        if isinstance(message, AIMessage) and message.content and not message.tool_calls:
+            return message.content
+    return state.get(report_key) or f"分析师 {name} 未能在时间预算内完成报告。"
+
 # --- 节点定义 (Nodes) ---
 
 def run_analyst(agent, name, state, report_key, feedback_key):
@@ -45,45 +110,55 @@ def run_analyst(agent, name, state, report_key, feedback_key):
     支持两轮模式：
     - 第一轮：根据用户查询撰写初稿。
     - 第二轮：根据审计员的反馈优化报告。
+    每轮受 ANALYST_BUDGET_SECONDS 约束，超时后提交目前最好的报告，
+    从而保证审计员不会被单个缓慢的分析师拖住。
     """
     user_query = state['messages'][0]
     current_round = state.get('round_count', 0)
     feedback = state.get(feedback_key, "")
+    deadline = time.monotonic() + ANALYST_BUDGET_SECONDS
     
     print(f"  [分析师 {name}] 正在思考与工作 (第 {current_round + 1} 轮)...")
     
-    # 构建输入消息
-    messages = [user_query]
-    
-    # 如果是第二轮，添加反馈信息
+    # 如果是第二轮，提示收到的反馈
     if current_round > 0 and feedback:
         print(f"    [分析师 {name}] 收到反馈: {feedback[:50]}...")
-        feedback_msg = HumanMessage(content=f"这是审计员对你上一轮报告的反馈：\n{feedback}\n\n请根据此反馈修改并优化你的报告。")
-        messages.append(feedback_msg)
+    
+    # 构建输入消息：用户查询在前 (各分析师共享前缀)，身份与反馈在后
+    messages = analyst_messages(user_query, name, current_round, feedback)
+    
+    # 第一轮的首次调用只需决定搜索内容 (plan)，其余调用撰写初稿 (draft) 或修改稿 (revise)；
+    # 第二轮需要在已有报告的基础上修改，直接使用 revise
+    write_step = "revise" if current_round > 0 else "draft"
+    step = "plan" if current_round == 0 else write_step
     
     # 简单的 ReAct 循环
-    for _ in range(5): 
-        response = agent.invoke(messages)
+    for i in range(5): 
+        # 模型调用同样受剩余预算约束
+        future = model_executor.submit(agent.invoke, list(messages), step=step)
+        done, _ = wait([future], timeout=max(deadline - time.monotonic(), 0))
+        if not done:
+            print(f"    [分析师 {name}] 已超出时间预算，提交当前最佳报告。")
+            break
+        response = future.result()
+        
+        if step == "plan" and not response.tool_calls:
+            # 便宜档位没有发起搜索时给出的回答不算报告，交给撰写步骤重新生成
+            step = write_step
+            continue
+        step = write_step
         messages.append(response)
         
         if response.tool_calls:
-            for tool_call in response.tool_calls:
-                if tool_call['name'] == 'tavily_search':
-                    print(f"    [分析师 {name}] 正在搜索: {tool_call['args']['query']}")
-                    try:
-                        res = tavily_search.invoke(tool_call['args']['query'])
-                    except Exception as e:
-                        res = str(e)
-                    
-                    messages.append(ToolMessage(
-                        tool_call_id=tool_call['id'], 
-                        name=tool_call['name'], 
-                        content=str(res)
-                    ))
+            messages.extend(run_tool_calls(name, response.tool_calls, deadline))
         else:
             return {report_key: response.content}
+        
+        if time.monotonic() >= deadline:
+            print(f"    [分析师 {name}] 已超出时间预算，提交当前最佳报告。")
+            break
             
-    return {report_key: messages[-1].content}
+    return {report_key: best_report(name, messages, state, report_key)}
 
 def analyst_a_node(state: AgentState):
     return run_analyst(analyst_a, "A", state, "report_a", "feedback_a")
@@ -94,6 +169,9 @@ def analyst_b_node(state: AgentState):
 def analyst_c_node(state: AgentState):
     return run_analyst(analyst_c, "C", state, "report_c", "feedback_c")
 
+# 获胜者名称 -> 状态中对应的报告字段
+REPORT_KEYS = {"Analyst_A": "report_a", "Analyst_B": "report_b", "Analyst_C": "report_c"}
+
 def auditor_node(state: AgentState):
     """
     审计员节点：
@@ -104,30 +182,20 @@ def auditor_node(state: AgentState):
     
     if current_round == 0:
         print("  [审计员] 正在进行第一轮评审，生成改进建议...")
-        input_text = (
-            f"用户查询: {state['messages'][0].content}\n\n"
-            f"--- 分析师 A 初稿 ---\n{state.get('report_a', '无')}\n\n"
-            f"--- 分析师 B 初稿 ---\n{state.get('report_b', '无')}\n\n"
-            f"--- 分析师 C 初稿 ---\n{state.get('report_c', '无')}\n\n"
+        messages = auditor_messages(
+            state['messages'][0].content,
+            {"A": state.get('report_a'), "B": state.get('report_b'), "C": state.get('report_c')},
+            "初稿",
             "请分别为这三份报告提供简短、具体的改进建议（优缺点分析）。\n"
             "请以 JSON 格式输出，键为 'feedback_a', 'feedback_b', 'feedback_c'。"
         )
         
-        response = auditor_agent.invoke([HumanMessage(content=input_text)])
+        response = auditor_agent.invoke(messages, step="critique")
         content = response.content
         
         # 解析 JSON
-        import json
         try:
-            if "```json" in content:
-                json_str = content.split("```json")[1].split("```")[0]
-            elif "{" in content:
-                start = content.find("{")
-                end = content.rfind("}") + 1
-                json_str = content[start:end]
-            else:
-                json_str = content
-            data = json.loads(json_str)
+            data = parse_json_block(content)
         except:
             print("  [审计员] 解析反馈失败，使用通用反馈。")
             data = {
@@ -145,37 +213,33 @@ def auditor_node(state: AgentState):
         
     else:
         print("  [审计员] 正在进行最终评审，选出获胜者...")
-        input_text = (
-            f"用户查询: {state['messages'][0].content}\n\n"
-            f"--- 分析师 A 终稿 ---\n{state.get('report_a', '无')}\n\n"
-            f"--- 分析师 B 终稿 ---\n{state.get('report_b', '无')}\n\n"
-            f"--- 分析师 C 终稿 ---\n{state.get('report_c', '无')}\n\n"
+        messages = auditor_messages(
+            state['messages'][0].content,
+            {"A": state.get('report_a'), "B": state.get('report_b'), "C": state.get('report_c')},
+            "终稿",
             "请选出最佳报告。\n"
-            "输出 JSON: { 'winner': 'Analyst_X', 'reason': '...', 'final_report': '...' }"
+            "输出 JSON: { 'winner': 'Analyst_X', 'reason': '...' }"
         )
         
-        response = auditor_agent.invoke([HumanMessage(content=input_text)])
+        response = auditor_agent.invoke(messages, step="judge")
         content = response.content
         
-        import json
         try:
-            if "```json" in content:
-                json_str = content.split("```json")[1].split("```")[0]
-            elif "{" in content:
-                start = content.find("{")
-                end = content.rfind("}") + 1
-                json_str = content[start:end]
-            else:
-                json_str = content
-            data = json.loads(json_str)
+            data = parse_json_block(content)
         except:
-            data = {"winner": "Analyst_A", "reason": "解析失败，默认选择 A", "final_report": state.get("report_a")}
+            data = {"winner": "Analyst_A", "reason": "解析失败，默认选择 A"}
+        
+        # 获胜报告直接取自状态，审计员无需在输出中复述全文
+        winner = data.get("winner")
+        if winner not in REPORT_KEYS:
+            winner = "Analyst_A"
+            data["reason"] = f"无法识别的获胜者 {data.get('winner')}，默认选择 A。{data.get('reason') or ''}"
             
-        print(f"  [审计员] 最终获胜者: {data.get('winner')}")
+        print(f"  [审计员] 最终获胜者: {winner}")
         return {
-            "winner": data.get("winner"),
+            "winner": winner,
             "audit_reason": data.get("reason"),
-            "final_report": data.get("final_report"),
+            "final_report": state.get(REPORT_KEYS[winner]) or "",
             "messages": [response]
         }
 
@@ -192,7 +256,10 @@ def blockchain_node(state: AgentState):
         "winner": winner,
         "report_snippet": report[:100] + "...", # 仅记录摘要以节省空间
         "reason": reason,
-        "status": "VERIFIED" # 已验证
+        "status": "VERIFIED", # 已验证
+        # 运行元数据，供 ledger_analytics.py 导出统计
+        "query": state['messages'][0].content,
+        "report_length": len(report),
     }
     
     print("  [区块链] 正在记录结果...")
@@ -213,11 +280,17 @@ def blockchain_node(state: AgentState):
     
     # 生成 HTML 研报
     query = state['messages'][0].content
-    html_path = generate_html_report(query, winner, report, reason, block_hash, reward_msg)
-    print(f"  [系统] HTML 研报已生成: {html_path}")
-    
-    # 自动打开 HTML 文件 (适用于 macOS)
-    os.system(f"open {html_path}")
+    if sandbox_dir():
+        # 磁带回放：研报写入临时目录，且不自动打开浏览器
+        html_path = generate_html_report(query, winner, report, reason, block_hash, reward_msg,
+                                         filename=os.path.join(sandbox_dir(), "financial_report.html"))
+        print(f"  [系统] HTML 研报已生成 (回放): {html_path}")
+    else:
+        html_path = generate_html_report(query, winner, report, reason, block_hash, reward_msg)
+        print(f"  [系统] HTML 研报已生成: {html_path}")
+        
+        # 自动打开 HTML 文件 (适用于 macOS)
+        os.system(f"open {html_path}")
     
     return {"block_hash": block_hash}
 
@@ -297,7 +370,14 @@ app = workflow.compile()
 
 if __name__ == "__main__":
     print("=== FinChain-Agent 演示 (并行竞争模式) ===")
-    user_query = input("请输入您的金融查询: ")
+    # 回放模式直接使用录制时的查询；录制模式保存本次查询
+    user_query = cassette.recorded_query() if cassette.mode == "replay" else None
+    if user_query:
+        print(f"回放查询: {user_query}")
+    else:
+        user_query = input("请输入您的金融查询: ")
+        if cassette.mode == "record":
+            cassette.record_query(user_query)
     
     initial_state = {"messages": [HumanMessage(content=user_query)]}
     
@@ -305,3 +385,6 @@ if __name__ == "__main__":
     # 增加递归限制以防止复杂任务中断
     for event in app.stream(initial_state, {"recursion_limit": 100}):
         pass # 输出已在节点内部打印
+    
+    # 打印各路由的延迟与费用
+    router.print_report()
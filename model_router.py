@@ -0,0 +1,219 @@
+import os
+import json
+import time
+import threading
+from langchain_openai import ChatOpenAI
+from cassette import api_key, llm_cache
+from utils import parse_json_block
+
+# --- 模型路由与级联 (Model Routing & Cascade) ---
+# 每个角色/步骤 (route) 对应一条模型级联：先用便宜的模型，
+# 只有当输出未通过校验 (置信度低于阈值) 时才升级到下一档位。
+# 默认的 lite / standard / long 是同一个 deepseek-chat，只是输出上限 (max_tokens) 不同，
+# 升级解决的是输出被截断的问题，而不是换用能力更强的模型；只有 reasoner 是不同的模型。
+# 可通过 FINCHAIN_MODEL_ROUTES 指向一个 JSON 文件覆盖 tiers / routes / prices。
+
+DEEPSEEK_API_BASE = 'https://api.deepseek.com'
+
+# 单次模型请求的 HTTP 超时 (秒)，档位配置中的 "timeout" 可单独覆盖
+MODEL_TIMEOUT_SECONDS = float(os.environ.get("FINCHAIN_MODEL_TIMEOUT", "120"))
+
+# 模型档位 (前三档仅 max_tokens 不同)
+MODEL_TIERS = {
+    "lite": {"model": "deepseek-chat", "max_tokens": 256, "tools": True},
+    "standard": {"model": "deepseek-chat", "max_tokens": 1024, "tools": True},
+    "long": {"model": "deepseek-chat", "max_tokens": 4096, "tools": True},
+    "reasoner": {"model": "deepseek-reasoner", "max_tokens": 8192, "tools": False},
+}
+
+# 价格 (美元 / 百万 Token)，可按 DeepSeek 最新报价更新；cached_input 为前缀缓存命中部分的价格
+MODEL_PRICES = {
+    "deepseek-chat": {"input": 0.27, "cached_input": 0.07, "output": 1.10},
+    "deepseek-reasoner": {"input": 0.55, "cached_input": 0.14, "output": 2.19},
+}
+
+
+def cached_tokens(response) -> int:
+    """读取前缀缓存命中的 Token 数 (DeepSeek 的 prompt_cache_hit_tokens，或 OpenAI 风格的 cached_tokens)。"""
+    token_usage = response.response_metadata.get("token_usage") or {}
+    if token_usage.get("prompt_cache_hit_tokens") is not None:
+        return token_usage["prompt_cache_hit_tokens"]
+    details = (response.usage_metadata or {}).get("input_token_details") or {}
+    return details.get("cache_read") or 0
+
+
+# --- 校验器：返回 0~1 的置信度 ---
+
+def _truncated(response) -> bool:
+    return response.response_metadata.get("finish_reason") == "length"
+
+
+def tool_call_or_complete(response) -> float:
+    """发起工具调用，或给出了完整 (未被截断) 的回答。"""
+    if response.tool_calls:
+        return 1.0
+    if _truncated(response) or not response.content.strip():
+        return 0.0
+    return 1.0
+
+
+def tool_call_required(response) -> float:
+    """只接受工具调用：plan 步骤只负责决定搜索内容，不产出报告。"""
+    return 1.0 if response.tool_calls else 0.0
+
+
+def json_with_keys(*keys):
+    """输出可解析为 JSON，置信度为必需字段的覆盖比例。"""
+    def validate(response) -> float:
+        if _truncated(response):
+            return 0.0
+        try:
+            data = parse_json_block(response.content)
+        except ValueError:
+            return 0.0
+        if not isinstance(data, dict):
+            return 0.0
+        return sum(1 for k in keys if data.get(k)) / len(keys)
+    return validate
+
+
+# 路由表：cascade 为升级顺序，min_confidence 为接受结果所需的最低置信度
+ROUTES = {
+    # 第一轮 ReAct 循环的首次调用只决定搜索什么，用最便宜的档位；
+    # 不发起搜索的回答不会被当作报告，分析师会转入 draft 步骤撰写 (见 main.run_analyst)
+    "analyst.plan": {"cascade": ["lite"], "min_confidence": 1.0, "validator": tool_call_required},
+    "analyst.draft": {"cascade": ["standard", "long"], "min_confidence": 1.0, "validator": tool_call_or_complete},
+    "analyst.revise": {"cascade": ["standard", "long"], "min_confidence": 1.0, "validator": tool_call_or_complete},
+    "auditor.critique": {
+        "cascade": ["standard", "long"],
+        "min_confidence": 1.0,
+        "validator": json_with_keys("feedback_a", "feedback_b", "feedback_c"),
+    },
+    # 评审只输出 winner / reason，获胜报告全文由 main.py 从状态中取出，无需长输出档位；
+    # JSON 不合格时直接换用 reasoner
+    "auditor.judge": {
+        "cascade": ["standard", "reasoner"],
+        "min_confidence": 1.0,
+        "validator": json_with_keys("winner", "reason"),
+    },
+}
+
+
+class ModelRouter:
+    def __init__(self, tiers=None, routes=None, prices=None):
+        self.tiers = tiers or MODEL_TIERS
+        self.routes = routes or ROUTES
+        self.prices = prices or MODEL_PRICES
+        self._models = {}
+        self._lock = threading.Lock()
+        # route -> tier -> 统计
+        self.stats = {}
+
+    def model(self, tier: str):
+        """按档位懒加载模型实例 (同一档位在各角色间共享)。"""
+        with self._lock:
+            if tier not in self._models:
+                config = self.tiers[tier]
+                self._models[tier] = ChatOpenAI(
+                    model=config["model"],
+                    openai_api_key=api_key("DEEPSEEK_API_KEY"),
+                    openai_api_base=DEEPSEEK_API_BASE,
+                    max_tokens=config["max_tokens"],
+                    timeout=config.get("timeout", MODEL_TIMEOUT_SECONDS),
+                    cache=llm_cache()
+                )
+            return self._models[tier]
+
+    def invoke(self, route: str, prompt_value, tools=None):
+        """按路由的级联顺序调用模型，返回第一个通过校验的响应。"""
+        config = self.routes[route]
+        cascade = [t for t in config["cascade"] if not tools or self.tiers[t].get("tools", True)]
+        validator = config.get("validator")
+        min_confidence = config.get("min_confidence", 1.0)
+
+        for i, tier in enumerate(cascade):
+            model = self.model(tier)
+            runnable = model.bind_tools(tools) if tools else model
+            start = time.monotonic()
+            response = runnable.invoke(prompt_value)
+            self._record(route, tier, response, time.monotonic() - start, escalated=False)
+
+            confidence = validator(response) if validator else 1.0
+            if confidence >= min_confidence or i == len(cascade) - 1:
+                return response
+            print(f"    [路由] {route} 在 {tier} 档位置信度 {confidence:.2f}，升级到 {cascade[i + 1]}...")
+            self._record(route, tier, None, 0.0, escalated=True)
+
+    def _record(self, route, tier, response, elapsed, escalated):
+        with self._lock:
+            entry = self.stats.setdefault(route, {}).setdefault(tier, {
+                "calls": 0, "escalations": 0, "latency": 0.0,
+                "input_tokens": 0, "cached_tokens": 0, "output_tokens": 0, "cost": 0.0,
+            })
+            if escalated:
+                entry["escalations"] += 1
+                return
+            usage = response.usage_metadata or {}
+            price = self.prices.get(self.tiers[tier]["model"], {"input": 0, "output": 0})
+            input_tokens = usage.get("input_tokens", 0)
+            cached = min(cached_tokens(response), input_tokens)
+            entry["calls"] += 1
+            entry["latency"] += elapsed
+            entry["input_tokens"] += input_tokens
+            entry["cached_tokens"] += cached
+            entry["output_tokens"] += usage.get("output_tokens", 0)
+            entry["cost"] += ((input_tokens - cached) * price["input"]
+                              + cached * price.get("cached_input", price["input"])
+                              + usage.get("output_tokens", 0) * price["output"]) / 1_000_000
+
+    def print_report(self):
+        """打印各路由的调用次数、平均延迟、Token、前缀缓存命中率与费用。"""
+        print("\n=== 模型路由统计 ===")
+        print(f"{'路由':<18}{'档位':<10}{'调用':>6}{'升级':>6}{'平均延迟(s)':>12}{'输入Token':>11}{'缓存命中':>9}{'输出Token':>11}{'费用($)':>10}")
+        total, total_input, total_cached = 0.0, 0, 0
+        for route, tiers in sorted(self.stats.items()):
+            for tier, s in tiers.items():
+                avg = s["latency"] / s["calls"] if s["calls"] else 0.0
+                hit_rate = s["cached_tokens"] / s["input_tokens"] if s["input_tokens"] else 0.0
+                total += s["cost"]
+                total_input += s["input_tokens"]
+                total_cached += s["cached_tokens"]
+                print(f"{route:<18}{tier:<10}{s['calls']:>6}{s['escalations']:>6}{avg:>12.2f}"
+                      f"{s['input_tokens']:>11}{hit_rate:>9.0%}{s['output_tokens']:>11}{s['cost']:>10.4f}")
+        overall = total_cached / total_input if total_input else 0.0
+        print(f"总费用: ${total:.4f}  前缀缓存命中率: {overall:.0%}")
+
+
+class RoutedAgent:
+    """
+    Prompt + 路由后的模型。
+    与原先的 `prompt | llm` 用法一致，只是调用时需要指明步骤 (step)。
+    """
+
+    def __init__(self, router: ModelRouter, role: str, prompt, tools=None):
+        self.router = router
+        self.role = role
+        self.prompt = prompt
+        self.tools = tools
+
+    def invoke(self, messages, step: str):
+        prompt_value = self.prompt.invoke({"messages": messages})
+        return self.router.invoke(f"{self.role}.{step}", prompt_value, tools=self.tools)
+
+
+def _router_from_env():
+    path = os.environ.get("FINCHAIN_MODEL_ROUTES")
+    if not path:
+        return ModelRouter()
+    with open(path, 'r') as f:
+        overrides = json.load(f)
+    tiers = {**MODEL_TIERS, **overrides.get("tiers", {})}
+    routes = {name: dict(config) for name, config in ROUTES.items()}
+    for name, config in overrides.get("routes", {}).items():
+        routes.setdefault(name, {}).update(config)
+    prices = {**MODEL_PRICES, **overrides.get("prices", {})}
+    return ModelRouter(tiers, routes, prices)
+
+
+# 全局路由器
+router = _router_from_env()
@@ -0,0 +1,31 @@
+from langchain_core.messages import HumanMessage
+
+# --- Prompt 组装 (Prompt Assembly) ---
+# DeepSeek 会对请求的公共前缀做磁盘 KV 缓存，命中部分的首 Token 延迟和费用都更低。
+# 因此所有 Prompt 按照“越稳定越靠前”的顺序组装：
+#   1. 静态前缀：系统提示词 + 工具定义 (所有分析师、所有轮次完全相同，见 agents.py)
+#   2. 本次运行的内容：用户查询，以及分析师报告等研究资料
+#   3. 每位分析师 / 每一轮的后缀：身份、审计反馈、本轮指令
+# 这样三位分析师的六次调用都能共享系统提示词与用户查询这段前缀；
+# 两次审计的报告内容不同 (初稿 / 终稿)，只共享系统提示词与用户查询。
+
+
+def analyst_messages(user_query, name: str, current_round: int, feedback: str):
+    """分析师输入：用户查询在前，身份与反馈作为后缀。"""
+    suffix = f"你是金融分析师 {name}。"
+    if current_round > 0 and feedback:
+        suffix += f"\n这是审计员对你上一轮报告的反馈：\n{feedback}\n\n请根据此反馈修改并优化你的报告。"
+    else:
+        suffix += "\n请开始研究并撰写报告。"
+    return [user_query, HumanMessage(content=suffix)]
+
+
+def auditor_messages(query: str, reports: dict, stage: str, instruction: str):
+    """
+    审计员输入：单条 HumanMessage，按 用户查询 → 各分析师报告 (固定顺序) → 本轮指令 拼接。
+    前缀缓存按 Token 匹配，拆成多条消息并不会多命中；而 deepseek-reasoner 不接受连续的 user 消息。
+    """
+    report_text = "\n\n".join(
+        f"--- 分析师 {label} {stage} ---\n{report or '无'}" for label, report in reports.items()
+    )
+    return [HumanMessage(content=f"用户查询: {query}\n\n{report_text}\n\n{instruction}")]
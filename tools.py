@@ -1,11 +1,16 @@
 import os
 from langchain_core.tools import tool
 from tavily import TavilyClient
-from utils import calculate_hash, get_timestamp
+from cassette import wrap_search_client, sandbox_dir, CassetteMissError
+from ledger_backend import open_backend
 
 # Initialize Tavily Client
 # Note: In a real app, we'd handle missing keys more gracefully
-tavily_client = TavilyClient(api_key=os.environ.get("TAVILY_API_KEY"))
+# 启用磁带时，搜索请求会被录制或从本地回放
+tavily_client = wrap_search_client(lambda: TavilyClient(api_key=os.environ.get("TAVILY_API_KEY")))
+
+# 单次搜索的超时时间 (秒)，同时作为 HTTP 请求超时传给 Tavily，超时的连接不会在后台一直挂起
+TOOL_TIMEOUT_SECONDS = float(os.environ.get("FINCHAIN_TOOL_TIMEOUT", "30"))
 
 @tool
 def tavily_search(query: str):
@@ -21,7 +26,8 @@ def tavily_search(query: str):
             topic="finance",
             days=7, # 关注最近 7 天的新闻
             include_answer=True,
-            max_results=5
+            max_results=5,
+            timeout=TOOL_TIMEOUT_SECONDS
         )
         
         # 格式化输出，使其对智能体更友好
@@ -33,86 +39,50 @@ def tavily_search(query: str):
             results.append(f"标题: {res['title']}\n链接: {res['url']}\n内容: {res['content']}\n---")
             
         return "\n\n".join(results)
+    except CassetteMissError:
+        # 磁带缺失需要直接暴露，不能伪装成普通的搜索错误
+        raise
     except Exception as e:
         return f"搜索执行错误: {e}"
 
-class TokenManager:
-    def __init__(self, ledger_file="token_ledger.json"):
-        self.ledger_file = ledger_file
-        self.balances = self._load_ledger()
+# 区块链与代币账本共用同一个存储后端 (FINCHAIN_LEDGER_BACKEND: json / sqlite)
+# 磁带回放时写入临时目录，避免回归测试改动生产账本
+ledger = open_backend(root=sandbox_dir())
 
-    def _load_ledger(self):
-        """加载代币账本"""
-        if os.path.exists(self.ledger_file):
-            try:
-                import json
-                with open(self.ledger_file, 'r') as f:
-                    return json.load(f)
-            except:
-                pass
-        # 初始分配：系统 DAO 拥有 100万 FCA
-        return {"AnalystAgent": 0, "AuditAgent": 0, "SystemDAO": 1000000}
+class TokenManager:
+    def __init__(self, backend=None):
+        self.backend = backend or ledger
 
-    def _save_ledger(self):
-        """保存代币账本"""
-        import json
-        with open(self.ledger_file, 'w') as f:
-            json.dump(self.balances, f, indent=4)
+    @property
+    def balances(self):
+        return self.backend.balances()
 
     def reward_agent(self, agent_name: str, amount: int, reason: str):
         """
         奖励智能体 FCA 代币。
         """
-        if agent_name not in self.balances:
-            self.balances[agent_name] = 0
-        
-        self.balances[agent_name] += amount
-        self.balances["SystemDAO"] -= amount
-        self._save_ledger()
-        return f"奖励: {amount} FCA 给 {agent_name}，原因: {reason}。新余额: {self.balances[agent_name]} FCA"
+        balance = self.backend.transfer("SystemDAO", agent_name, amount, reason)
+        return f"奖励: {amount} FCA 给 {agent_name}，原因: {reason}。新余额: {balance} FCA"
 
     def get_balance(self, agent_name: str):
-        return self.balances.get(agent_name, 0)
+        return self.backend.get_balance(agent_name)
 
 # 实例化代币管理器
 token_manager = TokenManager()
 
 class BlockchainMock:
-    def __init__(self, ledger_file="blockchain_ledger.json"):
-        self.ledger_file = ledger_file
-        self.chain = []
-        # 如果存在，加载现有区块链
-        if os.path.exists(ledger_file):
-            try:
-                import json
-                with open(ledger_file, 'r') as f:
-                    self.chain = json.load(f)
-            except:
-                self.chain = []
+    def __init__(self, backend=None):
+        self.backend = backend or ledger
 
     def add_block(self, data: dict):
         """
         模拟向区块链添加区块。
+        区块的序号与 previous_hash 由后端在写入时根据链头确定。
         """
-        timestamp = get_timestamp()
-        # 创建区块内容
-        block = {
-            "index": len(self.chain) + 1,
-            "timestamp": timestamp,
-            "data": data,
-            "previous_hash": self.chain[-1]["hash"] if self.chain else "0",
-        }
-        # 计算当前区块的哈希
-        block["hash"] = calculate_hash(block)
-        
-        self.chain.append(block)
-        self._save_ledger()
-        return block
+        return self.backend.append_block(data)
 
-    def _save_ledger(self):
-        import json
-        with open(self.ledger_file, 'w') as f:
-            json.dump(self.chain, f, indent=4)
+    def iter_blocks(self, start: int = 1):
+        return self.backend.iter_blocks(start)
 
 # 实例化模拟区块链
 blockchain = BlockchainMock()
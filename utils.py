@@ -10,3 +10,15 @@ def calculate_hash(data: dict) -> str:
 def get_timestamp() -> str:
     """Returns current timestamp."""
     return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
+
+def parse_json_block(content: str) -> dict:
+    """Extracts and parses the JSON object from an LLM response (raises ValueError on failure)."""
+    if "```json" in content:
+        json_str = content.split("```json")[1].split("```")[0]
+    elif "{" in content:
+        start = content.find("{")
+        end = content.rfind("}") + 1
+        json_str = content[start:end]
+    else:
+        json_str = content
+    return json.loads(json_str)
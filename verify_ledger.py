@@ -0,0 +1,111 @@
+import os
+import json
+import tempfile
+from ledger_backend import JsonLedgerBackend, open_backend, verify_chain
+from ledger_compaction import compact, _digest
+
+# 在临时目录中走一遍 写入 → 压缩 → 校验 → 重新加载 → 自动压缩 → 篡改检测 → 迁移 的完整流程，
+# 不会读写项目目录下的正式账本。
+
+def check(condition, message):
+    print(f"  [{'通过' if condition else '失败'}] {message}")
+    if not condition:
+        raise SystemExit(1)
+
+
+def expect_rejected(root, message):
+    try:
+        open_backend("json", root=root)
+        check(False, f"{message}: 未被发现")
+    except ValueError as e:
+        check(True, f"{message}: 加载时拒绝 ({e})")
+
+
+def write_sample(backend, blocks=12, transfers=8):
+    for i in range(blocks):
+        backend.append_block({"query": f"测试查询 {i}", "winner": f"Analyst_{'ABC'[i % 3]}", "status": "VERIFIED"})
+    for i in range(transfers):
+        backend.transfer("SystemDAO", f"Analyst_{'ABC'[i % 3]}", 10, "Test Reward")
+
+
+def test_ledger_round_trip():
+    print("=== Testing Ledger Compaction & Migration ===")
+    root = tempfile.mkdtemp(prefix="finchain-verify-")
+
+    backend = open_backend("json", root=root)
+    if "FINCHAIN_COMPACT_EVERY" not in os.environ:
+        check(backend.compact_every > 0, f"默认开启自动压缩 (阈值 {backend.compact_every})")
+    write_sample(backend)
+    height, balances = backend.head()[0], backend.balances()
+
+    print("\n压缩 (保留 3 个尾部区块)...")
+    snapshot = compact(backend, keep_tail=3)
+    check(snapshot["chain"]["height"] == height - 3, f"快照高度 {snapshot['chain']['height']}")
+    check(verify_chain(backend) == (True, height), "压缩后整条链校验通过")
+
+    print("\n重新加载...")
+    reloaded = open_backend("json", root=root)
+    check(reloaded.head()[0] == height, f"链高度保持 {height}")
+    check(reloaded.balances() == balances, "余额与压缩前一致")
+    write_sample(reloaded, blocks=2, transfers=2)
+    check(verify_chain(reloaded)[0], "压缩后继续写入，链仍然有效")
+
+    print("\n自动压缩 (compact_every=5)...")
+    auto = JsonLedgerBackend(reloaded.chain_file, reloaded.balances_file, reloaded.journal_file,
+                             reloaded.snapshot_file, reloaded.blobs, reloaded.archive_dir, compact_every=5)
+    write_sample(auto, blocks=7, transfers=6)
+    check(len(auto.chain) < 5 and auto.seq - auto.journal_seq < 5, "尾部区块与流水保持在阈值以内")
+    check(verify_chain(auto)[0], "自动压缩后链仍然有效")
+    height, balances = auto.head()[0], auto.balances()
+
+    print("\n迁移到 SQLite...")
+    target = open_backend("sqlite", root=root)
+    target.migrate_from(open_backend("json", root=root))
+    check(target.head() == auto.head(), f"链头一致 (高度 {height})")
+    check(target.balances() == balances, "余额一致")
+    check(verify_chain(target) == (True, height), "SQLite 账本校验通过")
+
+    print("\n篡改快照...")
+    with open(auto.snapshot_file, 'r') as f:
+        original = f.read()
+
+    def forge(alg=None):
+        snapshot = json.loads(original)
+        snapshot["tokens"]["balances"]["Analyst_A"] += 1000
+        if alg:
+            # 重新计算签名并声明为无密钥的 sha256 (签名类型降级)
+            payload = {k: v for k, v in snapshot.items() if k != "signature"}
+            snapshot["signature"] = {"alg": alg, "value": _digest(payload, None)[1]}
+        with open(auto.snapshot_file, 'w') as f:
+            json.dump(snapshot, f)
+
+    forge()
+    expect_rejected(root, "修改余额")
+
+    # 使用 HMAC 密钥重新签名快照，再尝试降级伪造
+    with open(auto.snapshot_file, 'w') as f:
+        f.write(original)
+    previous_key = os.environ.get("FINCHAIN_LEDGER_KEY")
+    os.environ["FINCHAIN_LEDGER_KEY"] = "verify-ledger-secret"
+    try:
+        expect_rejected(root, "设置密钥后加载无密钥快照")
+        compact(auto, keep_tail=0)
+        signed = open_backend("json", root=root)
+        check(signed.balances() == balances and verify_chain(signed) == (True, height), "HMAC 签名快照可正常加载，链仍然有效")
+        with open(auto.snapshot_file, 'r') as f:
+            original = f.read()
+        forge()
+        expect_rejected(root, "修改 HMAC 签名快照的余额")
+        forge(alg="sha256")
+        expect_rejected(root, "将签名类型降级为 sha256")
+    finally:
+        if previous_key is None:
+            os.environ.pop("FINCHAIN_LEDGER_KEY", None)
+        else:
+            os.environ["FINCHAIN_LEDGER_KEY"] = previous_key
+
+    print(f"\n全部检查通过 (临时目录: {root})")
+
+
+if __name__ == "__main__":
+    test_ledger_round_trip()